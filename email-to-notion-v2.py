@@ -1,15 +1,28 @@
 import imaplib
 import email
-from email.header import decode_header
+import select
+import ssl
+from email.header import decode_header, make_header
+from email.message import Message
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr
 import os
 from datetime import datetime, timedelta
 import re
-from notion_client import Client
-import json
-from typing import List, Dict, Optional
+import base64
+import binascii
+import quopri
+import ahocorasick
+from dateutil.parser import parse as date_parse
+from notion_client import Client, APIErrorCode, APIResponseError
+import orjson
+from typing import List, Dict, Optional, Set
 import time
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from functools import cached_property
 import sqlite3
 import schedule
 from logging.handlers import RotatingFileHandler
@@ -18,44 +31,140 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
+# Patterns used to find potential due dates in email content
+DUE_DATE_PATTERNS = [
+    re.compile(r"\b(?:due\s(?:on|by)?\s)?(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b", re.IGNORECASE),   # Formats like "due on 12/31/2024"
+    re.compile(r"\b(?:due\s(?:on|by)?\s)?((?:\d{1,2}\s)?(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s\d{2,4})\b", re.IGNORECASE),  # "due by 31 Dec 2024"
+]
+
+# Patterns used to take apart UID FETCH responses
+FETCH_UID_PATTERN = re.compile(rb"UID (\d+)")
+FETCH_START_PATTERN = re.compile(rb"\d+ \(")
+FETCH_BODY_LITERAL_PATTERN = re.compile(rb"BODY\[[^\]]*\](?:<\d+>)? \{\d+\}$")
+FETCH_LITERAL_PATTERN = re.compile(rb"\{\d+\}$")
+IMAP_TOKEN_PATTERN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+# The header pass only needs a few fields, so it never parses a MIME body
+HEADER_PARSER = BytesHeaderParser()
+
+# Text part used when BODYSTRUCTURE can't be read: section "" fetches the whole message
+FULL_MESSAGE_PART = ("", None, None)
+
+# Number of processed emails written before committing mid-run
+PROCESSED_CHECKPOINT_SIZE = 50
+
+# Runs an email may fail in before it is recorded as failed and no longer retried
+MAX_EMAIL_ATTEMPTS = 3
+
+# Notion allows about 3 requests per second sustained, so requests are spaced out across
+# all workers and rate limited ones are retried after the Retry-After delay
+NOTION_MAX_WORKERS = 4
+NOTION_MIN_REQUEST_INTERVAL = 1 / 3
+NOTION_MAX_RETRIES = 3
+
+# Gmail drops idle IMAP connections after about 10 minutes, so IDLE is renewed before that
+IMAP_HOST = "imap.gmail.com"
+IDLE_TIMEOUT_SECONDS = 9 * 60
+
 class ConfigManager:
     def __init__(self, config_dir: str = "config"):
         self.config_dir = Path(config_dir)
         self.config_dir.mkdir(exist_ok=True)
+        self.logger = logging.getLogger("EmailProcessor")
+        self.config_mtimes = {}
         self.load_configs()
 
+    def reload_if_changed(self) -> bool:
+        """Reload the configuration only if a config file changed since it was loaded"""
+        for filename, mtime in self.config_mtimes.items():
+            try:
+                current_mtime = (self.config_dir / filename).stat().st_mtime_ns
+            except FileNotFoundError:
+                current_mtime = None
+            if current_mtime != mtime:
+                break
+        else:
+            return False
+
+        try:
+            self.load_configs()
+        except (orjson.JSONDecodeError, OSError, KeyError, TypeError, AttributeError) as e:
+            # Usually a file caught mid-save; the old mtimes make the next run try again
+            self.logger.warning(f"Could not reload configuration, keeping the previous one: {str(e)}")
+            return False
+        return True
+
     def load_configs(self):
         """Load all configuration files"""
-        self.keywords = self.load_json_config("keywords.json", {
+        mtimes = {}
+        keywords = self.load_json_config("keywords.json", {
             'assignment': ['assignment', 'homework', 'hw', 'project', 'submit', 'submission'],
             'exam': ['exam', 'test', 'quiz', 'midterm', 'final', 'assessment'],
             'deadline': ['deadline', 'due', 'due date', 'by', 'until'],
             'meeting': ['meeting', 'class', 'lecture', 'seminar', 'workshop']
-        })
+        }, mtimes)
+        keyword_automaton = self.build_keyword_automaton(keywords)
         
-        self.schedule_config = self.load_json_config("schedule.json", {
+        schedule_config = self.load_json_config("schedule.json", {
             "fixed_times": ["09:00", "12:00", "15:00", "18:00", "21:00"],
             "interval_minutes": 30,
             "catch_up_missed": True,
             "max_catch_up_hours": 24
-        })
+        }, mtimes)
         
-        self.ignore_list = self.load_json_config("ignore_list.json", {
+        ignore_list = self.load_json_config("ignore_list.json", {
             "emails": [],
             "subjects": [],
             "domains": []
-        })
+        }, mtimes)
+        # Addresses and domains are matched case-insensitively by set lookup
+        ignore_emails = frozenset(address.lower() for address in ignore_list["emails"])
+        ignore_domains = frozenset(domain.lower() for domain in ignore_list["domains"])
+
+        # Subjects are compared against lowercased email subjects
+        ignore_list["subjects"] = [subject.lower() for subject in ignore_list["subjects"]]
+        ignore_subject_re = re.compile(
+            "|".join(re.escape(subject) for subject in ignore_list["subjects"])
+        ) if ignore_list["subjects"] else None
+
+        # Swap everything in together so a failed load never leaves a mix of old and new config
+        self.keywords = keywords
+        self.keyword_automaton = keyword_automaton
+        self.schedule_config = schedule_config
+        self.ignore_list = ignore_list
+        self.ignore_emails = ignore_emails
+        self.ignore_domains = ignore_domains
+        self.ignore_subject_re = ignore_subject_re
+        self.config_mtimes = mtimes
 
-    def load_json_config(self, filename: str, default_config: dict) -> dict:
-        """Load a JSON config file or create with defaults if it doesn't exist"""
+    def build_keyword_automaton(self, keywords: Dict[str, List[str]]) -> Optional[ahocorasick.Automaton]:
+        """Build a single Aho-Corasick automaton matching every keyword to its task types"""
+        task_types_by_keyword = {}
+        for task_type, task_keywords in keywords.items():
+            for keyword in task_keywords:
+                task_types_by_keyword.setdefault(keyword.lower(), []).append(task_type)
+
+        if not task_types_by_keyword:
+            return None
+
+        automaton = ahocorasick.Automaton()
+        for keyword, task_types in task_types_by_keyword.items():
+            automaton.add_word(keyword, tuple(task_types))
+        automaton.make_automaton()
+        return automaton
+
+    def load_json_config(self, filename: str, default_config: dict, mtimes: dict) -> dict:
+        """Load a JSON config file or create with defaults if it doesn't exist, recording its mtime"""
         file_path = self.config_dir / filename
         if not file_path.exists():
-            with open(file_path, 'w') as f:
-                json.dump(default_config, f, indent=4)
+            with open(file_path, 'wb') as f:
+                f.write(orjson.dumps(default_config, option=orjson.OPT_INDENT_2))
+            mtimes[filename] = file_path.stat().st_mtime_ns
             return default_config
         
-        with open(file_path, 'r') as f:
-            return json.load(f)
+        mtimes[filename] = file_path.stat().st_mtime_ns
+        with open(file_path, 'rb') as f:
+            return orjson.loads(f.read())
 
 class EmailProcessor:
     def __init__(self, email_address: str, email_password: str, notion_token: str, database_id: str):
@@ -64,8 +173,13 @@ class EmailProcessor:
         # self.credentials = Credentials(email_address, email_password)
         # self.account = Account(email_address, credentials=self.credentials, autodiscover=True, access_type=DELEGATE)
 
-        self.notion = Client(auth=notion_token)
+        self.notion_token = notion_token
         self.database_id = database_id
+
+        # Notion requests run in the background while the next email is decoded
+        self.notion_pool = ThreadPoolExecutor(max_workers=NOTION_MAX_WORKERS)
+        self.notion_rate_lock = threading.Lock()
+        self.notion_next_request = 0.0
         
         # Initialize configuration manager
         self.config = ConfigManager()
@@ -82,6 +196,19 @@ class EmailProcessor:
         self.last_run_file = Path("data/last_run.txt")
         self.load_last_run_time()
 
+        # Long-lived IMAP connection shared by every run
+        self.mail = None
+        self.uidvalidity = None
+        self.new_mail_pending = False
+
+        # Schedule config the registered re-sync jobs were built from
+        self.active_schedule_config = None
+
+    @cached_property
+    def notion(self) -> Client:
+        """Notion client, created on first use so runs without new mail never build it"""
+        return Client(auth=self.notion_token)
+
     def setup_logging(self):
         """Setup rotating log file"""
         log_file = Path("logs/email_processor.log")
@@ -106,11 +233,128 @@ class EmailProcessor:
         console_handler.setFormatter(formatter)
         self.logger.addHandler(console_handler)
 
+    def connect(self) -> imaplib.IMAP4_SSL:
+        """Open, authenticate and select the inbox on a new IMAP connection"""
+        self.logger.info("Connecting to IMAP server...")
+        self.mail = imaplib.IMAP4_SSL(IMAP_HOST)
+        self.mail.login(self.email_address, self.email_password)
+        self.mail.select("inbox")
+
+        # Stored UIDs are only meaningful for the UIDVALIDITY they were recorded under
+        _, data = self.mail.response("UIDVALIDITY")
+        self.uidvalidity = int(data[0]) if data and data[0] else None
+        return self.mail
+
+    def get_connection(self) -> imaplib.IMAP4_SSL:
+        """Return the open IMAP connection, reconnecting if it has dropped"""
+        if self.mail is not None:
+            try:
+                # NOOP doubles as the keep-alive heartbeat between IDLE periods
+                self.mail.noop()
+                return self.mail
+            except (imaplib.IMAP4.error, OSError) as e:
+                self.logger.warning(f"IMAP connection lost, reconnecting: {str(e)}")
+                self.close_connection()
+        return self.connect()
+
+    def close_connection(self):
+        """Log out and drop the IMAP connection"""
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+        self.mail = None
+
+    def take_untagged_responses(self, mail: imaplib.IMAP4) -> bool:
+        """Clear the untagged responses imaplib has collected, returning whether any was EXISTS"""
+        # They are otherwise only cleared by SELECT and would pile up on a long-lived connection
+        exists = "EXISTS" in mail.untagged_responses
+        mail.untagged_responses.clear()
+        return exists
+
+    def has_buffered_input(self, mail: imaplib.IMAP4) -> bool:
+        """Check, without blocking, whether a response is already waiting to be read"""
+        # Lines already in imaplib's read buffer or decrypted by SSL never wake select()
+        mail.sock.setblocking(False)
+        try:
+            return bool(mail.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            mail.sock.setblocking(True)
+
+    def is_exists_response(self, line: bytes) -> bool:
+        """Check whether a response line announces new mail"""
+        return line.startswith(b"*") and line.rstrip().upper().endswith(b"EXISTS")
+
+    def wait_for_new_mail(self, timeout: float) -> bool:
+        """Block in IMAP IDLE until new mail arrives or the timeout expires"""
+        mail = None
+        try:
+            mail = self.get_connection()
+
+            # EXISTS reported during the last run or the heartbeat NOOP won't be announced again
+            if self.take_untagged_responses(mail) or self.new_mail_pending:
+                self.new_mail_pending = False
+                return True
+
+            tag = mail._new_tag()
+            mail.send(tag + b" IDLE\r\n")
+            response = mail.readline()
+            if not response.startswith(b"+"):
+                raise imaplib.IMAP4.error(f"IDLE not accepted: {response!r}")
+
+            new_mail = False
+            deadline = time.monotonic() + timeout
+            while not new_mail:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not self.has_buffered_input(mail):
+                    ready, _, _ = select.select([mail.sock], [], [], remaining)
+                    if not ready:
+                        break
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                new_mail = self.is_exists_response(line)
+
+            # End IDLE and consume everything up to the tagged completion
+            mail.send(b"DONE\r\n")
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+                if line.startswith(tag):
+                    break
+                new_mail = new_mail or self.is_exists_response(line)
+            mail.tagged_commands.pop(tag, None)
+            return new_mail
+
+        except (imaplib.IMAP4.error, OSError) as e:
+            self.close_connection()
+            if mail is None:
+                # Server unreachable; wait out this period rather than retrying in a tight loop
+                self.logger.warning(f"IMAP reconnect failed, retrying later: {str(e)}")
+                self.new_mail_pending = True
+                time.sleep(timeout)
+                return False
+
+            # Re-sync after reconnecting in case mail arrived while the connection was down
+            self.logger.warning(f"IDLE interrupted, forcing a re-sync: {str(e)}")
+            return True
+
     def init_database(self):
         """Initialize SQLite database for tracking processed emails"""
         db_path = Path("data/processed_emails.db")
         self.conn = sqlite3.connect(db_path)
         cursor = self.conn.cursor()
+
+        # WAL with NORMAL sync avoids an fsync per commit while staying crash safe
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
         
         # Create table if it doesn't exist
         cursor.execute('''
@@ -121,90 +365,186 @@ class EmailProcessor:
                 status TEXT
             )
         ''')
+
+        # Highest UID seen per mailbox, only valid while UIDVALIDITY is unchanged
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS imap_state (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                last_uid INTEGER
+            )
+        ''')
+
+        # Failed attempts for emails that haven't been processed yet
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS failed_attempts (
+                message_id TEXT PRIMARY KEY,
+                attempts INTEGER
+            )
+        ''')
         self.conn.commit()
 
+    def load_last_uid(self) -> Optional[int]:
+        """Load the last processed UID for the inbox, if the server's UIDs are still valid"""
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT uidvalidity, last_uid FROM imap_state WHERE mailbox = ?", ("inbox",))
+        row = cursor.fetchone()
+        if row is None or row[0] != self.uidvalidity:
+            return None
+        return row[1]
+
+    def save_last_uid(self, last_uid: int):
+        """Save the last processed UID for the inbox (caller commits)"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "INSERT OR REPLACE INTO imap_state (mailbox, uidvalidity, last_uid) VALUES (?, ?, ?)",
+            ("inbox", self.uidvalidity, last_uid)
+        )
+
     def load_last_run_time(self):
         """Load the last successful run time"""
         if self.last_run_file.exists():
             with open(self.last_run_file, 'r') as f:
                 last_run_str = f.read().strip()
+            try:
                 self.last_run_time = datetime.fromisoformat(last_run_str)
-        else:
-            self.last_run_time = datetime.now() - timedelta(hours=24)
-            self.save_last_run_time()
+                return
+            except ValueError:
+                self.logger.warning(f"Invalid last run time '{last_run_str}', falling back to 24 hours ago")
+
+        self.last_run_time = datetime.now() - timedelta(hours=24)
+        self.save_last_run_time()
 
     def save_last_run_time(self):
         """Save the current run time"""
-        with open(self.last_run_file, 'w') as f:
+        # Write to a temporary file and rename so a crash never leaves the file empty
+        tmp_file = self.last_run_file.with_name(self.last_run_file.name + ".tmp")
+        with open(tmp_file, 'w') as f:
             f.write(datetime.now().isoformat())
+        os.replace(tmp_file, self.last_run_file)
 
-
-    def is_email_processed(self, message_id: str) -> bool:
-        """Check if email has already been processed"""
+    def filter_unprocessed(self, message_ids: List[str]) -> Set[str]:
+        """Return the message IDs that have not been processed yet"""
         cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM processed_emails WHERE message_id = ?", (message_id,))
-        return cursor.fetchone() is not None
+        ids = list(set(message_ids))
+        processed = set()
 
-    def mark_email_processed(self, message_id: str, subject: str, status: str = "success"):
-        """Mark email as processed in database"""
+        # Stay below SQLite's limit on bound parameters per statement
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT message_id FROM processed_emails WHERE message_id IN ({placeholders})",
+                chunk
+            )
+            processed.update(row[0] for row in cursor.fetchall())
+
+        return set(ids) - processed
+
+    def mark_emails_processed(self, emails: List[tuple], status: str = "success"):
+        """Mark a batch of (message_id, subject) pairs as processed (caller commits)"""
+        if not emails:
+            return
+        processed_date = datetime.now()
         cursor = self.conn.cursor()
-        cursor.execute(
-            "INSERT INTO processed_emails (message_id, subject, processed_date, status) VALUES (?, ?, ?, ?)",
-            (message_id, subject, datetime.now(), status)
+        cursor.executemany(
+            "INSERT OR IGNORE INTO processed_emails (message_id, subject, processed_date, status) VALUES (?, ?, ?, ?)",
+            [(message_id, subject, processed_date, status) for message_id, subject in emails]
         )
-        self.conn.commit()
+        cursor.executemany(
+            "DELETE FROM failed_attempts WHERE message_id = ?",
+            [(message_id,) for message_id, _ in emails]
+        )
+
+    def record_failed_attempts(self, failures: Dict[int, tuple]) -> Set[int]:
+        """Count a failed attempt per email and give up on those out of attempts (caller commits)"""
+        cursor = self.conn.cursor()
+        given_up = {}
+        for uid, (message_id, subject) in failures.items():
+            cursor.execute(
+                "INSERT INTO failed_attempts (message_id, attempts) VALUES (?, 1) "
+                "ON CONFLICT(message_id) DO UPDATE SET attempts = attempts + 1",
+                (message_id,)
+            )
+            cursor.execute("SELECT attempts FROM failed_attempts WHERE message_id = ?", (message_id,))
+            attempts = cursor.fetchone()[0]
+            if attempts >= MAX_EMAIL_ATTEMPTS:
+                self.logger.error(f"Giving up on email {message_id} after {attempts} failed attempts: {subject}")
+                given_up[uid] = (message_id, subject)
+
+        # Recording them as failed keeps them out of later runs and lets the UID watermark move on
+        self.mark_emails_processed(list(given_up.values()), status="failed")
+        return set(given_up)
+
+    def should_ignore(self, from_addr: str, subject_lower: str) -> bool:
+        """Check if email should be ignored based on ignore list (subject must be lowercased)"""
+        # Strip any display name so "Name <user@example.com>" matches the bare address
+        address = parseaddr(from_addr or "")[1].lower()
 
-    def should_ignore(self, from_addr: str, subject: str) -> bool:
-        """Check if email should be ignored based on ignore list"""
         # Check if email address is in ignore list
-        if from_addr in self.config.ignore_list["emails"]:
+        if address in self.config.ignore_emails:
             return True
             
         # Check if domain is in ignore list
-        domain = from_addr.split('@')[-1]
-        if domain in self.config.ignore_list["domains"]:
+        domain = address.split('@')[-1]
+        if domain in self.config.ignore_domains:
             return True
             
         # Check if subject contains any ignored phrases
-        for ignored_subject in self.config.ignore_list["subjects"]:
-            if ignored_subject.lower() in subject.lower():
-                return True
+        if self.config.ignore_subject_re and self.config.ignore_subject_re.search(subject_lower):
+            return True
                 
         return False
 
-    def detect_task_type(self, subject: str, body: str) -> List[str]:
-        """Detect task type based on keywords in subject and body"""
-        text = f"{subject.lower()} {body.lower()}"
-        detected_types = []
-        
-        for task_type, keywords in self.config.keywords.items():
-            if any(keyword in text for keyword in keywords):
-                detected_types.append(task_type)
-                
+    def detect_task_type(self, subject_lower: str, body_lower: str) -> List[str]:
+        """Detect task type based on keywords in the lowercased subject and body"""
+        text = f"{subject_lower} {body_lower}"
+        automaton = self.config.keyword_automaton
+        if automaton is None:
+            return ['other']
+
+        # One pass over the text reports every keyword hit across all task types
+        matched_types = set()
+        for _, task_types in automaton.iter(text):
+            matched_types.update(task_types)
+
+        # Keep the configured task type order
+        detected_types = [task_type for task_type in self.config.keywords if task_type in matched_types]
         return detected_types if detected_types else ['other']
     
-    def parse_due_date(content: str) -> Optional[str]:
+    def parse_due_date(self, content: str) -> Optional[str]:
         """Extract a due date from the email content if available."""
         try:
-            # Define a regex pattern to find potential dates in the content
-            date_patterns = [
-                r"\b(?:due\s(?:on|by)?\s)?(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})\b",   # Formats like "due on 12/31/2024"
-                r"\b(?:due\s(?:on|by)?\s)?((?:\d{1,2}\s)?(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s\d{2,4})\b",  # "due by 31 Dec 2024"
-            ]
-
             # Try to match any of the date patterns
-            for pattern in date_patterns:
-                match = re.search(pattern, content, re.IGNORECASE)
+            for pattern in DUE_DATE_PATTERNS:
+                match = pattern.search(content)
                 if match:
                     # Parse and standardize the found date
                     due_date = date_parse(match.group(1), fuzzy=True)
-                    self.logger.error(f"Due_data found in email: {title}")
+                    self.logger.info(f"Due date found in email: {due_date.date()}")
                     return due_date.strftime("%Y-%m-%d")  # Format as "YYYY-MM-DD" for Notion
 
         except Exception as e:
             self.logger.error(f"No due_data found: {str(e)}")
         return None  # Return None if no due date found
 
+    def wait_for_notion_slot(self):
+        """Block until this thread may send the next Notion request"""
+        # Each caller reserves the next free slot, so requests stay spaced out across threads
+        with self.notion_rate_lock:
+            now = time.monotonic()
+            slot = max(now, self.notion_next_request)
+            self.notion_next_request = slot + NOTION_MIN_REQUEST_INTERVAL
+        if slot > now:
+            time.sleep(slot - now)
+
+    def get_retry_after(self, error: APIResponseError) -> float:
+        """Read the Retry-After delay from a rate limited Notion response"""
+        try:
+            return float(error.headers.get("Retry-After", 1))
+        except (AttributeError, TypeError, ValueError):
+            return 1.0
+
     def create_notion_page(self, title: str, content: str, task_types: List[str], due_date: Optional[str] = None):
         """Create a new page in Notion database"""
         try:
@@ -217,115 +557,438 @@ class EmailProcessor:
             if due_date:
                 properties["Due Date"] = {"date": {"start": due_date}}
 
-            self.notion.pages.create(
-                parent={"database_id": self.database_id},
-                properties=properties,
-                children=[
-                    {
-                        "object": "block",
-                        "type": "paragraph",
-                        "paragraph": {
-                            "rich_text": [{
-                                "type": "text",
-                                "text": {"content": content}
-                            }]
-                        }
-                    }
-                ]
-            )
+            for attempt in range(NOTION_MAX_RETRIES + 1):
+                self.wait_for_notion_slot()
+                try:
+                    self.notion.pages.create(
+                        parent={"database_id": self.database_id},
+                        properties=properties,
+                        children=[
+                            {
+                                "object": "block",
+                                "type": "paragraph",
+                                "paragraph": {
+                                    "rich_text": [{
+                                        "type": "text",
+                                        "text": {"content": content}
+                                    }]
+                                }
+                            }
+                        ]
+                    )
+                    break
+                except APIResponseError as e:
+                    if e.code != APIErrorCode.RateLimited or attempt == NOTION_MAX_RETRIES:
+                        raise
+                    retry_after = self.get_retry_after(e)
+                    self.logger.warning(f"Rate limited by Notion, retrying in {retry_after}s: {title}")
+                    time.sleep(retry_after)
             self.logger.info(f"Created Notion page: {title}")
         except Exception as e:
             self.logger.error(f"Error creating Notion page: {str(e)}")
             raise
 
-def process_emails(self, since_time: Optional[datetime] = None):
-    """Process new emails and create Notion tasks with optional due dates"""
-    try:
-        self.logger.info("Starting email processing...")
-        
-        mail = imaplib.IMAP4_SSL("imap.gmail.com")
-        mail.login(self.email_address, self.email_password)
-        mail.select("inbox")
-
-        # Search criteria based on time
-        if since_time:
-            date_str = since_time.strftime("%d-%b-%Y")
-            search_criteria = f'(SINCE "{date_str}")'
-        else:
-            date_str = (datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")
-            search_criteria = f'(SINCE "{date_str}")'
+    def build_ignore_criteria(self) -> str:
+        """Translate the ignored subject phrases into IMAP SEARCH NOT clauses"""
+        # Only subjects go to the server: SUBJECT is a substring match just like should_ignore,
+        # while FROM would also drop near-miss senders (jimbob@x.com for bob@x.com) that
+        # should_ignore matches exactly. Addresses and domains are filtered client-side.
+        clauses = []
+        for value in self.config.ignore_list["subjects"]:
+            clauses.append(f'NOT SUBJECT {self.quote_search_string(value)}')
+        # Non-ASCII entries would need a CHARSET search; should_ignore still catches them
+        clauses = [clause for clause in clauses if clause.isascii()]
+        return "".join(f" {clause}" for clause in clauses)
+
+    def quote_search_string(self, value: str) -> str:
+        """Quote a value for use in an IMAP SEARCH command"""
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"')
+        return f'"{escaped}"'
+
+    def compress_uid_set(self, uids) -> str:
+        """Build an IMAP sequence set, merging contiguous UIDs into a:b ranges"""
+        numbers = sorted({int(uid) for uid in uids})
+        ranges = []
+        start = end = numbers[0]
+        for number in numbers[1:]:
+            if number == end + 1:
+                end = number
+                continue
+            ranges.append(f"{start}:{end}" if start != end else str(start))
+            start = end = number
+        ranges.append(f"{start}:{end}" if start != end else str(start))
+        return ",".join(ranges)
+
+    def parse_fetch_response(self, data) -> List[tuple]:
+        """Extract (uid, envelope, payload) triples from a UID FETCH response"""
+        messages = []
+        for item in data:
+            # Literals come back as (envelope, literal) tuples, everything else as plain bytes
+            envelope, literal = item if isinstance(item, tuple) else (item, None)
+            if not messages or FETCH_START_PATTERN.match(envelope):
+                messages.append([b"", b""])
+            message = messages[-1]
+
+            if literal is not None and FETCH_BODY_LITERAL_PATTERN.search(envelope):
+                message[0] += envelope
+                message[1] = literal
+            elif literal is not None:
+                # A literal inside the envelope (e.g. a BODYSTRUCTURE filename) is just metadata
+                message[0] += FETCH_LITERAL_PATTERN.sub(b'""', envelope)
+            else:
+                message[0] += envelope
+
+        results = []
+        for envelope, payload in messages:
+            # Unsolicited FETCH responses (e.g. flag updates) carry no UID
+            match = FETCH_UID_PATTERN.search(envelope)
+            if match:
+                results.append((int(match.group(1)), envelope, payload))
+        return results
+
+    def parse_imap_list(self, data: bytes) -> list:
+        """Parse a parenthesized IMAP list (e.g. a BODYSTRUCTURE) into nested lists"""
+        stack = [[]]
+        pos = 0
+        while pos < len(data):
+            match = IMAP_TOKEN_PATTERN.match(data, pos)
+            if not match:
+                break
+            pos = match.end()
+            open_paren, close_paren, quoted, atom = match.groups()
+            if open_paren:
+                stack.append([])
+            elif close_paren:
+                item = stack.pop()
+                stack[-1].append(item)
+                if len(stack) == 1:
+                    return item
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb"\\(.)", rb"\1", quoted).decode(errors="replace"))
+            else:
+                stack[-1].append(None if atom.upper() == b"NIL" else atom.decode())
+        raise ValueError("Unterminated IMAP list")
 
-        self.logger.info(f"Searching emails with criteria: {search_criteria}")
-        _, messages = mail.search(None, search_criteria)
+    def find_text_part(self, structure: list, prefix: str = "") -> Optional[tuple]:
+        """Locate the first text/plain part in a BODYSTRUCTURE as (section, charset, encoding)
 
-        for message_num in messages[0].split():
+        A single-part message of any text type is used as is, like a non-multipart
+        message always was.
+        """
+        if isinstance(structure[0], list):
+            # Multipart: child parts come first, followed by the subtype and extensions
+            for index, part in enumerate(structure):
+                if not isinstance(part, list):
+                    break
+                text_part = self.find_text_part(part, f"{prefix}{index + 1}.")
+                if text_part:
+                    return text_part
+            return None
+
+        content_type, subtype, params = structure[0], structure[1], structure[2]
+        if (content_type or "").lower() != "text":
+            return None
+        if prefix and (subtype or "").lower() != "plain":
+            return None
+
+        charset = "utf-8"
+        if isinstance(params, list):
+            for key, value in zip(params[::2], params[1::2]):
+                if (key or "").lower() == "charset" and value:
+                    charset = value
+        section = prefix.rstrip(".") or "1"
+        return section, charset, (structure[5] or "7bit").lower()
+
+    def filter_new_emails(self, mail: imaplib.IMAP4, uids: List[bytes]) -> tuple:
+        """Fetch headers for all UIDs and return the unprocessed, non-ignored ones
+
+        Returns (pending, header_failures), both keyed by UID; header_failures maps
+        emails whose headers couldn't be read to (message_id, subject).
+        """
+        # Fetch only the headers needed for filtering, for all matches at once
+        _, header_data = mail.uid(
+            "FETCH",
+            self.compress_uid_set(uids),
+            "(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT FROM)])"
+        )
+
+        fetched_headers = []
+        header_failures = {}
+        for uid, envelope, header_bytes in self.parse_fetch_response(header_data):
+            # Derived from the UID so retries and dedupe see the same ID on every run
+            generated_id = f"generated-{self.uidvalidity}-{uid}"
+            message_id = generated_id
             try:
-                _, msg_data = mail.fetch(message_num, "(RFC822)")
-                email_body = msg_data[0][1]
-                email_message = email.message_from_bytes(email_body)
-                
-                # Get message ID for tracking
-                message_id = email_message["Message-ID"]
-                
+                headers = HEADER_PARSER.parsebytes(header_bytes)
+
+                # Get message ID for tracking; raw 8-bit values come back as unhashable Header objects
+                message_id = str(headers["Message-ID"] or "")
+
                 if not message_id:
                     self.logger.warning("Email without Message-ID found, generating unique ID")
-                    message_id = f"generated-{datetime.now().timestamp()}"
-                
-                # Skip if already processed
-                if self.is_email_processed(message_id):
-                    continue
+                    message_id = generated_id
+
+                # Work out which MIME section holds the plain text body
+                structure_start = envelope.find(b"BODYSTRUCTURE (")
+                try:
+                    if structure_start == -1:
+                        raise ValueError("not present in FETCH response")
+                    structure = self.parse_imap_list(envelope[structure_start + len(b"BODYSTRUCTURE "):])
+                    text_part = self.find_text_part(structure)
+                except (ValueError, IndexError) as e:
+                    self.logger.warning(f"Could not read BODYSTRUCTURE for email {message_id}, fetching it whole: {str(e)}")
+                    text_part = FULL_MESSAGE_PART
 
-                # Process email content
-                subject = decode_header(email_message["subject"])[0][0]
-                if isinstance(subject, bytes):
-                    subject = subject.decode()
-                from_addr = email_message.get("from")
+                fetched_headers.append((uid, message_id, headers, text_part))
+
+            except Exception as e:
+                self.logger.error(f"Error reading email headers: {str(e)}")
+                header_failures[uid] = (message_id or generated_id, "")
+                continue
 
-                self.logger.info(f"Processing email: {subject}")
+        # Skip emails that were already processed, checked in a single query
+        unprocessed_ids = self.filter_unprocessed([message_id for _, message_id, _, _ in fetched_headers])
+
+        pending = {}
+        for uid, message_id, headers, text_part in fetched_headers:
+            if message_id not in unprocessed_ids:
+                continue
+
+            try:
+                # Join every encoded word, not just the first one
+                subject = str(make_header(decode_header(headers["subject"] or "")))
+                subject_lower = subject.lower()
+                from_addr = headers.get("from")
 
                 # Skip if email should be ignored
-                if self.should_ignore(from_addr, subject):
+                if self.should_ignore(from_addr, subject_lower):
                     self.logger.info(f"Ignoring email: {subject}")
                     continue
 
-                # Get email content
-                content = self.extract_email_content(email_message)
+                pending[uid] = (message_id, subject, subject_lower, text_part)
 
-                # Extract due date from content if available
-                due_date = parse_due_date(content)
+            except Exception as e:
+                self.logger.error(f"Error reading email headers: {str(e)}")
+                header_failures[uid] = (message_id, "")
+                continue
 
-                # Create Notion page
-                task_types = self.detect_task_type(subject, content)
-                self.create_notion_page(subject, content, task_types, due_date)
-                
-                # Mark as processed
-                self.mark_email_processed(message_id, subject)
+        self.logger.info(f"{len(pending)} of {len(uids)} emails left after header filtering")
+        return pending, header_failures
+
+    def fetch_email_bodies(self, mail: imaplib.IMAP4, pending: Dict[int, tuple]) -> List[tuple]:
+        """Fetch only the text section of each email, one ranged request per section"""
+        bodies = []
+        uids_by_section = {}
+        for uid, (_, _, _, text_part) in pending.items():
+            if text_part is None:
+                # Nothing to download for emails without a plain text part
+                bodies.append((uid, b""))
+            else:
+                uids_by_section.setdefault(text_part[0], []).append(uid)
+
+        for section, uids in uids_by_section.items():
+            _, body_data = mail.uid("FETCH", self.compress_uid_set(uids), f"(BODY.PEEK[{section}])")
+            bodies.extend((uid, payload) for uid, _, payload in self.parse_fetch_response(body_data))
+        return bodies
+
+    def register_runs(self, scheduler: schedule.Scheduler, schedule_config: Dict):
+        """Register the scheduled re-sync runs for schedule_config on scheduler"""
+        for time_str in schedule_config["fixed_times"]:
+            scheduler.every().day.at(time_str).do(self.process_emails).tag("email-processing")
+
+        scheduler.every(schedule_config["interval_minutes"]).minutes.do(
+            self.process_emails
+        ).tag("email-processing")
+
+    def schedule_runs(self):
+        """(Re)register the scheduled re-sync runs from the schedule config
+
+        The new jobs are built on a throwaway scheduler first, so an invalid schedule
+        keeps the current jobs and schedule config instead of leaving no runs at all.
+        """
+        schedule_config = self.config.schedule_config
+        try:
+            self.register_runs(schedule.Scheduler(), schedule_config)
+        except (schedule.ScheduleError, KeyError, TypeError, ValueError) as e:
+            if self.active_schedule_config is None:
+                raise
+            self.logger.error(f"Invalid schedule config, keeping the current schedule: {str(e)}")
+            self.config.schedule_config = self.active_schedule_config
+            return
+
+        schedule.clear("email-processing")
+        self.register_runs(schedule.default_scheduler, schedule_config)
+        self.active_schedule_config = schedule_config
+
+    def process_emails(self, since_time: Optional[datetime] = None):
+        """Process new emails and create Notion tasks with optional due dates
+
+        Only mail newer than the last processed UID is searched; since_time is used
+        when no UID has been recorded yet for the current UIDVALIDITY.
+        """
+        try:
+            self.logger.info("Starting email processing...")
+
+            if self.config.reload_if_changed():
+                self.logger.info("Configuration files changed, reloaded")
+
+            mail = self.get_connection()
+
+            # Search for new UIDs, or by time on the first run, with the ignore list applied server-side
+            last_uid = self.load_last_uid()
+            if last_uid is not None:
+                search_range = f'UID {last_uid + 1}:*'
+            elif since_time:
+                search_range = f'SINCE "{since_time.strftime("%d-%b-%Y")}"'
+            else:
+                search_range = f'SINCE "{(datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")}"'
+            search_criteria = f'({search_range}{self.build_ignore_criteria()})'
+
+            self.logger.info(f"Searching emails with criteria: {search_criteria}")
+            _, messages = mail.uid("SEARCH", None, search_criteria)
+            uids = messages[0].split()
+
+            # "n:*" always matches the newest message, even when its UID is below n
+            if last_uid is not None:
+                uids = [uid for uid in uids if int(uid) > last_uid]
+
+            if not uids:
+                self.finish_run(mail)
+                self.logger.info("No emails found")
+                return
+
+            # Pass 1: filter on headers only
+            pending, header_failures = self.filter_new_emails(mail, uids)
+
+            # Pass 2: fetch the emails that survived filtering
+            bodies = self.fetch_email_bodies(mail, pending)
+
+            # Pass 3: decode, parse and hand off to Notion
+            notion_futures = {}
+            for uid, payload in bodies:
+                try:
+                    message_id, subject, subject_lower, text_part = pending[uid]
+
+                    self.logger.info(f"Processing email: {subject}")
+
+                    # Get email content
+                    content = self.extract_email_content(payload, text_part)
+                    content_lower = content.lower()
+
+                    # Extract due date from content if available
+                    due_date = self.parse_due_date(content)
+
+                    # Create Notion page
+                    task_types = self.detect_task_type(subject_lower, content_lower)
+                    future = self.notion_pool.submit(self.create_notion_page, subject, content, task_types, due_date)
+                    notion_futures[future] = (uid, message_id, subject)
+
+                except Exception as e:
+                    self.logger.error(f"Error processing individual email: {str(e)}")
+                    continue
+
+            processed = []
+            completed_uids = set()
+            for future in as_completed(notion_futures):
+                uid, message_id, subject = notion_futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Error processing individual email: {str(e)}")
+                    continue
+
+                completed_uids.add(uid)
+                processed.append((message_id, subject))
                 self.logger.info(f"Successfully processed email: {subject}")
 
-            except Exception as e:
-                self.logger.error(f"Error processing individual email: {str(e)}")
-                continue
+                # Checkpoint so an interrupted run doesn't recreate pages already sent to Notion
+                if len(processed) >= PROCESSED_CHECKPOINT_SIZE:
+                    self.mark_emails_processed(processed)
+                    self.conn.commit()
+                    processed.clear()
 
-        mail.logout()
-        self.logger.info("Completed email processing")
+            # Mark as processed
+            self.mark_emails_processed(processed)
 
-    except Exception as e:
-        self.logger.error(f"Error in process_emails: {str(e)}")
-        raise
+            # Emails that failed at any stage count an attempt; those out of attempts are dropped
+            failures = {uid: pending[uid][:2] for uid in pending if uid not in completed_uids}
+            failures.update(header_failures)
+            given_up_uids = self.record_failed_attempts(failures)
+
+            # Advance the UID watermark only past emails that don't need another attempt.
+            # Without a previous watermark, failures keep the SINCE search rather than
+            # risk widening the next search to the whole mailbox.
+            failed_uids = set(failures) - given_up_uids
+            if not failed_uids:
+                new_last_uid = max(int(uid) for uid in uids)
+            elif last_uid is not None:
+                new_last_uid = min(failed_uids) - 1
+            else:
+                new_last_uid = None
+            if new_last_uid is not None and (last_uid is None or new_last_uid > last_uid):
+                self.save_last_uid(new_last_uid)
+            self.conn.commit()
+
+            self.finish_run(mail)
+            self.logger.info("Completed email processing")
+
+        except Exception as e:
+            self.logger.error(f"Error in process_emails: {str(e)}")
+            if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                # Dropped connection; the next IDLE wait reconnects and re-syncs
+                self.close_connection()
+                self.new_mail_pending = True
+                return
+            raise
+
+    def finish_run(self, mail: imaplib.IMAP4):
+        """Record a successful run"""
+        # Remember mail announced while this run was busy so IDLE doesn't miss it
+        self.new_mail_pending = self.take_untagged_responses(mail)
 
-    def extract_email_content(self, email_message) -> str:
-        """Extract content from email message"""
+        self.save_last_run_time()
+        self.last_run_time = datetime.now()
+
+    def extract_email_content(self, payload: bytes, text_part: Optional[tuple]) -> str:
+        """Decode the fetched text section of an email"""
+        if text_part is None:
+            return ""
+        if text_part == FULL_MESSAGE_PART:
+            return self.extract_full_message_content(payload)
+
+        _, charset, encoding = text_part
+        if encoding == "base64":
+            try:
+                payload = base64.b64decode(payload)
+            except binascii.Error:
+                # Badly padded part; the email package decodes it leniently like a full parse would
+                part = Message()
+                part["Content-Transfer-Encoding"] = "base64"
+                part.set_payload(payload)
+                payload = part.get_payload(decode=True)
+        elif encoding == "quoted-printable":
+            payload = quopri.decodestring(payload)
+
+        try:
+            return payload.decode(charset, errors="replace")
+        except LookupError:
+            self.logger.warning(f"Unknown charset {charset}, decoding as UTF-8")
+            return payload.decode("utf-8", errors="replace")
+
+    def extract_full_message_content(self, payload: bytes) -> str:
+        """Extract content from a whole email message"""
+        email_message = email.message_from_bytes(payload)
         content = ""
         if email_message.is_multipart():
             for part in email_message.walk():
                 if part.get_content_type() == "text/plain":
                     try:
-                        content += part.get_payload(decode=True).decode()
+                        content += part.get_payload(decode=True).decode(part.get_content_charset() or "utf-8", errors="replace")
                     except Exception as e:
                         self.logger.error(f"Error decoding email part: {str(e)}")
         else:
             try:
-                content = email_message.get_payload(decode=True).decode()
+                content = email_message.get_payload(decode=True).decode(email_message.get_content_charset() or "utf-8", errors="replace")
             except Exception as e:
                 self.logger.error(f"Error decoding email content: {str(e)}")
         return content
@@ -347,17 +1010,21 @@ def run_processor():
         # Initial run
         processor.process_emails()
         
-        # Schedule regular runs
-        for time_str in processor.config.schedule_config["fixed_times"]:
-            schedule.every().day.at(time_str).do(processor.process_emails)
-        
-        schedule.every(processor.config.schedule_config["interval_minutes"]).minutes.do(
-            processor.process_emails
-        )
+        # Scheduled runs are only a safety re-sync; new mail is picked up through IDLE
+        processor.schedule_runs()
 
         while True:
             schedule.run_pending()
-            time.sleep(60)
+
+            # Re-register outside run_pending so jobs are never replaced from inside a running job
+            if processor.config.schedule_config != processor.active_schedule_config:
+                processor.schedule_runs()
+
+            # Wait in IDLE until new mail arrives, the next job is due or the connection needs renewing
+            idle_seconds = schedule.idle_seconds()
+            timeout = IDLE_TIMEOUT_SECONDS if idle_seconds is None else min(idle_seconds, IDLE_TIMEOUT_SECONDS)
+            if timeout > 0 and processor.wait_for_new_mail(timeout):
+                processor.process_emails()
 
     except Exception as e:
         logging.error(f"Fatal error in main process: {str(e)}")